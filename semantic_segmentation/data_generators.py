@@ -82,6 +82,8 @@ class BatchGenerator:
         self.__n_workers = n_workers
         self.__prepare_batch_size = prepare_batch_size
         self.__yield_incomplete_batches = yield_incomplete_batches
+        # пул процессов для предобработки, создается лениво при первом использовании
+        self.__pool = None
 
         assert markup_type in supported_markup_types, \
             f"now we support only one from {supported_markup_types.keys()} as markup_type"
@@ -198,15 +200,27 @@ class BatchGenerator:
         # не будем использовать multiprocessing
         map_fn = functools.partial(self._prepare_image, with_meta=with_meta)
         if self.__n_workers is not None and self.__n_workers > 1:
-            pool = multiprocessing.Pool(self.__n_workers)
-            preprocessed_data = [x for x in pool.map(map_fn, image_names) if x is not None]
-            pool.close()
-            pool.join()
+            # пул переиспользуется между порциями картинок:
+            # форкать и прогревать воркеров на каждые prepare_batch_size изображений слишком дорого
+            if self.__pool is None:
+                self.__pool = multiprocessing.Pool(self.__n_workers)
+            preprocessed_data = [x for x in self.__pool.map(map_fn, image_names) if x is not None]
             if not preprocessed_data:
                 logging.error("no data was preprocessed")
             return preprocessed_data
         else:
             return [x for x in map(map_fn, image_names) if x is not None]
 
+    def __getstate__(self):
+        # pool.map пиклит self вместе с map_fn для каждой задачи,
+        # а сам пул пиклиться не умеет - не отдаем его воркерам
+        state = self.__dict__.copy()
+        state['_BatchGenerator__pool'] = None
+        return state
+
+    def __del__(self):
+        if self.__pool is not None:
+            self.__pool.terminate()
+
     def is_augmentation_used(self):
         return self._use_augmentation
@@ -4,11 +4,15 @@
 """
 Работа с картами сегментаций - построение, препроцессинг, постпроцессинг, аугментация и т.д.
 """
-import math
+import functools
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
-from PIL import Image, ImageDraw
+from PIL import Image
 
 from semantic_segmentation.augmentation import SegLinksImageAugmentation
 from semantic_segmentation.data_markup import ObjectMarkup, ClassifiedObjectMarkup
@@ -19,6 +23,10 @@ class SegmapManager:
     """
     Класс для работы с картами сегментаций
     """
+    # минимальное число контуров, при котором окупается создание пула потоков в postprocess
+    _MIN_CONTOURS_FOR_PARALLEL = 8
+    # переиспользуемые на каждую картинку буферы (thread-local на случай вызова из нескольких потоков)
+    _thread_local = threading.local()
 
     @staticmethod
     def prepare_image_and_target(image, markup, net_config, augment=False):
@@ -39,7 +47,8 @@ class SegmapManager:
         return rescaled_image, rescaled_markup, segmentation_map
 
     @staticmethod
-    def postprocess(seg_map, seg_map_class_logits=None, scale=1, min_area_threshold=5):
+    def postprocess(seg_map, seg_map_class_logits=None, scale=1, min_area_threshold=5, average_probs=False,
+                    quantize_logits=False):
         """
         Выполняет постпроцессинг, т.е. по полученной карте сегментаций возвращает найденные объекты
         :param seg_map: карта сегментации чисто для детекции
@@ -49,25 +58,75 @@ class SegmapManager:
         :param min_area_threshold: минимальная площадь сегмента суперпикселей,
             при которой он еще считается детекцией, а не шумом (таким образом повышается precision,
             в результате уменьшения количества случайных срабатываний)
+        :param average_probs: если True, по контуру усредняются вероятности (после softmax),
+            если False - сырые логиты (экономится exp, т.к. argmax нужен только от среднего)
+        :param quantize_logits: квантовать карту логитов в int8 (вчетверо меньше трафика памяти
+            ценой небольшой ошибки округления); работает только при average_probs=False
         :return: список ObjectMarkup найденных объектов
         """
-        contours, boxes = get_contours_and_boxes(seg_map, min_area=min_area_threshold)
-        boxes = [np.round(box * scale).astype(int) for box in boxes]
+        # TC89_KCOS оставляет только доминантные точки контура - все последующие
+        # операции над контуром работают с меньшим числом вершин
+        contours, boxes = get_contours_and_boxes(seg_map, min_area=min_area_threshold,
+                                                 method=cv2.CHAIN_APPROX_TC89_KCOS)
+        if boxes:
+            # масштабируем и округляем все боксы одной векторной операцией,
+            # вместо пары временных массивов на каждый бокс
+            boxes_arr = np.stack(boxes) * scale
+            np.round(boxes_arr, out=boxes_arr)
+            boxes = list(boxes_arr.astype(int))
         if seg_map_class_logits is None:
             return [ObjectMarkup(bbox) for bbox in boxes]
 
-        seg_map_class_ps = np_softmax(seg_map_class_logits, axis=-1)
-
-        class_ids = []
-        for cnt in contours:
-            mask = np.zeros(seg_map.shape[:2], dtype=np.uint8)
-            cv2.drawContours(mask, [cnt], -1, 1, -1)
-            class_logits = seg_map_class_ps[mask.astype(np.bool)].mean(axis=0)
-            class_id = np.argmax(class_logits)
-            class_ids.append(class_id)
+        # float32 достаточно для классификации, а памяти гоняется вдвое меньше чем с float64
+        seg_map_class_logits = np.asarray(seg_map_class_logits, dtype=np.float32)
+        if seg_map_class_logits.shape[-1] == 1:
+            # с единственным классом классифицировать нечего - argmax по любому контуру даст 0
+            return [ClassifiedObjectMarkup(bbox, 0) for bbox in boxes]
+
+        if quantize_logits and not average_probs:
+            # argmax от средних логитов инвариантен к общему положительному аффинному преобразованию,
+            # так что для чистой классификации карту можно ужать в int8
+            logits_min, logits_max = seg_map_class_logits.min(), seg_map_class_logits.max()
+            if logits_max > logits_min:
+                seg_map_class_logits = np.asarray(
+                    (seg_map_class_logits - logits_min) * (127.0 / (logits_max - logits_min)), dtype=np.int8)
+
+        classify_fn = functools.partial(SegmapManager._classify_contour,
+                                        seg_map_class_logits=seg_map_class_logits, average_probs=average_probs)
+        # контуры независимы друг от друга, а cv2.drawContours/cv2.mean отпускают GIL,
+        # поэтому при большом числе детекций классифицируем их пулом потоков
+        if len(contours) >= SegmapManager._MIN_CONTOURS_FOR_PARALLEL:
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                class_ids = list(executor.map(classify_fn, contours))
+        else:
+            class_ids = [classify_fn(cnt) for cnt in contours]
 
         return [ClassifiedObjectMarkup(bbox, class_id) for bbox, class_id in zip(boxes, class_ids)]
 
+    @staticmethod
+    def _classify_contour(cnt, seg_map_class_logits, average_probs=False):
+        """
+        Определяет класс объекта как argmax усредненных по контуру логитов (или вероятностей) классов
+        :param cnt: контур объекта
+        :param seg_map_class_logits: карта логитов классов (H, W, C)
+        :param average_probs: усреднять вероятности (после softmax) вместо сырых логитов
+        :return: class_id
+        """
+        # маску достаточно рисовать в пределах bounding box контура,
+        # а не по всей карте сегментации - для разреженных детекций это на порядки меньше пикселей
+        x, y, w, h = cv2.boundingRect(cnt)
+        mask = np.zeros((h, w), dtype=np.uint8)
+        cv2.drawContours(mask, [cnt - [[x, y]]], -1, 1, -1)
+        region = seg_map_class_logits[y:y + h, x:x + w]
+        if average_probs:
+            # softmax считается поканально и независимо для каждого пикселя,
+            # так что его можно брать только от вырезанного региона - exp на остальной карте не нужен
+            region = np_softmax(region, axis=-1)
+        # cv2.mean считает среднее по маске одним проходом на C,
+        # без материализации копии пикселей как при индексации булевой маской
+        class_ps = [cv2.mean(region[..., class_idx], mask=mask)[0] for class_idx in range(region.shape[-1])]
+        return np.argmax(class_ps)
+
     @staticmethod
     def _augment(image, markup, net_config):
         # это сильно ускоряет аугментацию, и, как следствие, обучение, однако может ухудшить качество
@@ -86,22 +145,27 @@ class SegmapManager:
         :param markup:
         :param scale:
         :param for_drawing: если True в seg_map на местах bboxes будут 255, иначе то что стоит в markup.object_type
-        :return: pillow image (mode='L') - segmentation map
+        :return: numpy array (h, w) dtype=uint8 - segmentation map
         """
         w, h = image.size
         assert w % scale == 0 and h % scale == 0
-        image_segmap = Image.new(mode='L', size=(w // scale, h // scale), color=0)
-        draw = ImageDraw.Draw(image_segmap)
-        for object_markup in markup:
-            drawn_bbox = SegmapManager._proper_round(object_markup.bbox / scale)
+        canvas = np.zeros((h // scale, w // scale), dtype=np.uint8)
+
+        def get_fill_color(object_markup):
             if for_drawing:
-                fill_color = 255
-            else:
-                # добавляем 1 т.к. obj_type нумеруются с нуля
-                fill_color = object_markup.object_type + 1 if isinstance(object_markup, ClassifiedObjectMarkup) else 1
-                assert fill_color <= 255, "No more than 255 classes are supported"
-            draw.polygon(drawn_bbox.tolist(), fill=fill_color)
-        return image_segmap
+                return 255
+            # добавляем 1 т.к. obj_type нумеруются с нуля
+            fill_color = object_markup.object_type + 1 if isinstance(object_markup, ClassifiedObjectMarkup) else 1
+            assert fill_color <= 255, "No more than 255 classes are supported"
+            return fill_color
+
+        # растеризуем подряд идущие объекты одного цвета одним вызовом cv2.fillPoly;
+        # группируем только соседние объекты, чтобы при перекрытиях разных классов
+        # сохранить тот же порядок отрисовки, что и при отрисовке по одному
+        for fill_color, group in itertools.groupby(markup, key=get_fill_color):
+            polygons = [SegmapManager._proper_round(m.bbox / scale).reshape((-1, 2)) for m in group]
+            cv2.fillPoly(canvas, polygons, int(fill_color))
+        return canvas
 
     @staticmethod
     def _proper_round(markup_bbox):
@@ -114,9 +178,7 @@ class SegmapManager:
         if len(markup_bbox) != 8:
             # если попался многоугольник полученный из сегмапа не выпендриваемся и просто округляем
             return np.array(markup_bbox).astype(np.int32)
-        xs = markup_bbox[::2]
-        ys = markup_bbox[1::2]
-        assert len(xs) == len(ys) == 4
+        pts = np.asarray(markup_bbox, dtype=np.float64).reshape((4, 2))
 
         # итак, надо правильно округлить чтобы не потерять части объекта - вверх или вниз?
         # если для x_i есть хотя бы 2 других x_j больше него, значит объект лежит "выше" по координатам чем x_i
@@ -124,13 +186,10 @@ class SegmapManager:
         # и наоборот если есть хотя бы 2 других x_j меньше него округляем вверх
         # ситуация когда 1 больше 1 меньше 1 равен - округляется вверх (это не оптимально, но предполагается,
         # что такая ситуация почти не встречается)
-        xs_greater = [sum(1 for _x in xs if _x > x) for x in xs]
-        ys_greater = [sum(1 for _y in ys if _y > y) for y in ys]
-        xs = [math.floor(x) if n_greater > 1 else math.ceil(x) for (x, n_greater) in
-              zip(xs, xs_greater)]
-        ys = [math.floor(y) if n_greater > 1 else math.ceil(y) for (y, n_greater) in
-              zip(ys, ys_greater)]
-        return np.ravel(list(zip(xs, ys))).astype(np.int32)
+        # n_greater[i] - покоординатное количество точек строго больших i-й
+        n_greater = (pts[None, :, :] > pts[:, None, :]).sum(axis=1)
+        rounded = np.where(n_greater > 1, np.floor(pts), np.ceil(pts))
+        return rounded.ravel().astype(np.int32)
 
     @staticmethod
     def _rescale_image_and_markup(image, markup, net_config, max_side=None):
@@ -164,10 +223,25 @@ class SegmapManager:
             new_w = max(1, round(w / side_multiple)) * side_multiple
             new_h = max(1, round(h / side_multiple)) * side_multiple
 
-        resized_image = image.resize(size=(new_w, new_h), resample=Image.BICUBIC)  # TODO: check bilinear
+        # cv2.resize заметно быстрее пиллоувского resize:
+        # INTER_AREA - специализированный box-фильтр для уменьшения, INTER_LINEAR - для увеличения
+        interpolation = cv2.INTER_AREA if new_w * new_h < w * h else cv2.INTER_LINEAR
+        resized_image = Image.fromarray(cv2.resize(np.asarray(image), (new_w, new_h), interpolation=interpolation))
         if not markup:
             return resized_image, markup
-        scales = np.array([[new_w / w, new_h / h]])
+        # скретч-буфер вместо аллокации крошечного (1, 2) массива на каждую картинку
+        scales = getattr(SegmapManager._thread_local, 'scales', None)
+        if scales is None:
+            scales = SegmapManager._thread_local.scales = np.empty((1, 2))
+        scales[0, 0] = new_w / w
+        scales[0, 1] = new_h / h
+        # масштабируем точки всех bbox'ов одним умножением вместо отдельного маленького
+        # умножения на каждый объект; конкатенация (а не stack) - потому что многоугольники
+        # из сегмапов могут иметь разное число вершин
+        points_per_bbox = [len(m.bbox) // 2 for m in markup]
+        all_points = np.concatenate([np.asarray(m.bbox, dtype=np.float64) for m in markup]).reshape((-1, 2))
+        all_points *= scales
         resized_markup = [
-            m.create_same_markup((np.array(m.bbox).reshape((-1, 2)) * scales).reshape((-1,))) for m in markup]
+            m.create_same_markup(bbox_points.reshape((-1,)))
+            for m, bbox_points in zip(markup, np.split(all_points, np.cumsum(points_per_bbox)[:-1]))]
         return resized_image, resized_markup
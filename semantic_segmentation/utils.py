@@ -4,7 +4,7 @@
 """
 Всевозможные вспомогательные функции
 """
-import glob
+import functools
 import logging
 import os
 
@@ -19,6 +19,15 @@ def fix_quadrangle(quad):
     :param quad: список 4x точек на плоскости
     :return: четырехугольник являющийся выпуклой оболочкой
     """
+    pts = np.asarray(quad)
+    # типичный случай - выпуклый невырожденный четырехугольник (все векторные произведения
+    # соседних сторон одного знака), для него не нужно строить shapely-полигон,
+    # который на каждый вызов аллоцирует объекты в GEOS
+    edges = np.roll(pts, -1, axis=0) - pts
+    cross = edges[:, 0] * np.roll(edges[:, 1], -1) - edges[:, 1] * np.roll(edges[:, 0], -1)
+    if np.all(cross > 0) or np.all(cross < 0):
+        return pts
+
     word_poly = Polygon(quad)
     is_valid = word_poly.is_valid
     if not is_valid:
@@ -30,11 +39,16 @@ def fix_quadrangle(quad):
 
 
 def pillow_rgb_fromarray(img):
-    img = img.astype(np.uint8)
+    # copy=False - если картинка уже uint8, работаем с ней без лишней копии
+    img = np.asarray(img).astype(np.uint8, copy=False)
     if img.ndim == 3 and img.shape[-1] == 3:
         return Image.fromarray(img, 'RGB')
 
-    return pillow_grey_fomarray(img).convert('RGB')
+    if img.ndim == 3 and img.shape[2] == 1:
+        img = img[..., 0]  # view, а не копия как при squeeze+astype
+    assert img.ndim == 2  # серое изображение
+    # утраиваем канал одним проходом cv2 вместо создания 'L'-картинки и convert('RGB')
+    return Image.fromarray(cv2.cvtColor(img, cv2.COLOR_GRAY2RGB), 'RGB')
 
 
 def pillow_grey_fomarray(img, dsize=None):
@@ -48,11 +62,17 @@ def pillow_grey_fomarray(img, dsize=None):
     return img
 
 
-def get_contours_and_boxes(seg_map, min_area=10):
+def get_contours_and_boxes(seg_map, min_area=10, method=cv2.CHAIN_APPROX_SIMPLE):
     _, cnts, _ = cv2.findContours(np.array(seg_map, dtype=np.uint8),
-                                  mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE)
+                                  mode=cv2.RETR_EXTERNAL, method=method)
 
-    cnts = list(filter(lambda cnt: cv2.contourArea(cnt) > min_area, cnts))
+    def is_big_enough(cnt):
+        # площадь bounding box - дешевая верхняя оценка площади контура,
+        # честный contourArea считаем только для прошедших грубый фильтр
+        _, _, w, h = cv2.boundingRect(cnt)
+        return w * h > min_area and cv2.contourArea(cnt) > min_area
+
+    cnts = list(filter(is_big_enough, cnts))
     rects = [cv2.minAreaRect(cnt) for cnt in cnts]
     boxes = [cv2.boxPoints(rect).reshape((8,)) for rect in rects]
     assert len(boxes) == len(cnts)
@@ -82,7 +102,9 @@ def get_polygon_sides_lengths(poly):
     :param poly:
     :return:
     """
-    return [np.sum((poly[i] - poly[(i + 1) % len(poly)]) ** 2) ** 0.5 for i in range(len(poly))]
+    poly = np.asarray(poly)
+    diffs = poly - np.roll(poly, -1, axis=0)
+    return np.sqrt((diffs * diffs).sum(axis=1))
 
 
 def is_quad_square(quad, treshold=0.1):
@@ -97,6 +119,22 @@ def is_image_extension(ext):
     return ext.lower() in IMAGE_EXTENSIONS
 
 
+@functools.lru_cache(maxsize=32)
+def _index_images_folder(images_folder_path):
+    """
+    Строит отображение (имя файла без расширения) -> (имя файла изображения) одним проходом по папке
+    кэшируется, чтобы не сканировать папку заново на каждый файл разметки
+    :param images_folder_path:
+    :return:
+    """
+    index = {}
+    for entry in os.scandir(images_folder_path):
+        fname, ext = os.path.splitext(entry.name)
+        if is_image_extension(ext):
+            index[fname] = entry.name
+    return index
+
+
 def find_corresponding_image(images_folder_path, fname_without_ext):
     """
     Находит изображение с тем же именем, что и файл разметки, если такого нет кидает исключение
@@ -104,11 +142,10 @@ def find_corresponding_image(images_folder_path, fname_without_ext):
     :param fname_without_ext:
     :return:
     """
-    for full_image_name in glob.glob(os.path.join(images_folder_path, fname_without_ext) + '.*'):
-        image_ext = os.path.splitext(full_image_name)[1]
-        if is_image_extension(image_ext):
-            return fname_without_ext + image_ext
-    raise ValueError("Image corresponding to fname {} not found (skipping markup)".format(fname_without_ext))
+    try:
+        return _index_images_folder(images_folder_path)[fname_without_ext]
+    except KeyError:
+        raise ValueError("Image corresponding to fname {} not found (skipping markup)".format(fname_without_ext))
 
 
 def extract_bboxes_and_object_types(image_markup, net_config, object_types_format="name"):
@@ -133,6 +170,19 @@ def extract_bboxes_and_object_types(image_markup, net_config, object_types_forma
 
 
 def np_softmax(logits, axis=-1):
-    x = logits - np.max(logits, axis=axis, keepdims=True)
-    x = np.exp(x)
-    return x / np.sum(x, axis=axis, keepdims=True)
+    """
+    Численно устойчивый softmax
+    считается в float32 и по месту (один буфер на вычитание, экспоненту и нормировку),
+    чтобы не выделять по промежуточному массиву на каждую операцию
+    :param logits:
+    :param axis:
+    :return:
+    """
+    x = np.subtract(logits, np.max(logits, axis=axis, keepdims=True), dtype=np.float32)
+    np.exp(x, out=x)
+    # деление заменено на умножение на обратное: reciprocal считается по маленькому
+    # массиву сумм, а по большому массиву идет более дешевое умножение
+    norm = np.sum(x, axis=axis, keepdims=True)
+    np.reciprocal(norm, out=norm)
+    x *= norm
+    return x
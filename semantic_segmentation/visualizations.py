@@ -131,7 +131,8 @@ class Visualizer:
         :param result_fname: если не None, сохраняет туда получившееся изображение
         :return: image_with_markup
         """
-        seg_map = SegmapManager.build_segmentation_map(image, markup, scale=1, for_drawing=True)
+        seg_map = utils.pillow_grey_fomarray(SegmapManager.build_segmentation_map(image, markup,
+                                                                                  scale=1, for_drawing=True))
         return Visualizer.draw_segmentation_map(image, seg_map, result_fname=result_fname)
 
     @staticmethod